@@ -46,6 +46,7 @@ find the function that a user actually wants.
 
 """
 
+import functools
 import importlib
 import os
 from os import path
@@ -91,6 +92,21 @@ def _register():
 DUMPBACKENDS = _register()
 
 
+@functools.lru_cache(maxsize=None)
+def _lookup(extension):
+    """Find the registered dump backend supporting a file extension.
+
+    The result is cached, so the cache must be cleared if DUMPBACKENDS gets
+    modified.
+
+    """
+    for dump_backend in DUMPBACKENDS.values():
+        if extension in dump_backend.extensions:
+            return dump_backend
+
+    return None
+
+
 def dump(trace_path, output_dir=None, calls=None):
     """Wrapper for dumping traces.
 
@@ -101,16 +117,16 @@ def dump(trace_path, output_dir=None, calls=None):
     """
     name, extension = path.splitext(trace_path)
 
-    for dump_backend in DUMPBACKENDS.values():
-        if extension in dump_backend.extensions:
-            backend = dump_backend.backend
+    dump_backend = _lookup(extension)
+    if dump_backend is None:
+        raise DumpBackendError(
+            'No module supports file extensions "{}"'.format(extension))
 
-            if backend is None:
-                raise DumpBackendNotImplementedError(
-                    'DumpBackend for "{}" is not implemented'.format(extension))
+    backend = dump_backend.backend
 
-            instance = backend(trace_path, output_dir, calls)
-            return instance.dump()
+    if backend is None:
+        raise DumpBackendNotImplementedError(
+            'DumpBackend for "{}" is not implemented'.format(extension))
 
-    raise DumpBackendError(
-        'No module supports file extensions "{}"'.format(extension))
+    instance = backend(trace_path, output_dir, calls)
+    return instance.dump()
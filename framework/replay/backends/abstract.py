@@ -85,13 +85,16 @@ class DumpBackend(metaclass=abc.ABCMeta):
         print(msg, flush=True)
 
     @staticmethod
-    def _run_logged_command(cmd, env):
+    def _run_logged_command(cmd, env, cwd=None):
         # Explicitly send the stderr to the fd at sys.stderr in case it was
         # redirected for the parent process.
         # See:
         # https://bugs.python.org/issue44158
+        # Only pass cwd along when a backend needs it, the other ones keep
+        # running from our own working directory.
+        kwargs = {'cwd': cwd} if cwd is not None else {}
         ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=sys.stderr,
-                             env=env)
+                             env=env, **kwargs)
         logoutput = '[dump_trace_images] Running: {}\n'.format(
             ' '.join(cmd)).encode() + ret.stdout
         print(logoutput.decode(errors='replace'))
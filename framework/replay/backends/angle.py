@@ -6,7 +6,7 @@
 
 """ Module providing an ANGLE dump backend for replayer """
 
-from os import chdir, path, rename
+from os import path, replace
 from typing import List, Union
 
 from framework import core, exceptions
@@ -28,6 +28,12 @@ class ANGLETraceBackend(DumpBackend):
 
     _get_last_frame_call = None  # this silences the abstract-not-subclassed warning
 
+    # name prefix of the ANGLE restricted traces libraries
+    _LIB_PREFIX = 'libangle_restricted_traces_'
+
+    # arguments passed to every replay, whatever the trace
+    _STATIC_ARGS = ('--one-frame-only', '--use-angle=vulkan', '--save-screenshots')
+
     def __init__(self, trace_path: str, output_dir: Union[str, None] = None,
                  calls: Union[List[str], None] = None, **kwargs: str) -> None:
         super().__init__(trace_path, output_dir, calls, **kwargs)
@@ -38,6 +44,20 @@ class ANGLETraceBackend(DumpBackend):
                                              ('replay', 'angle_bin'),
                                              default='./angle_trace_tests')
             self._retrace_cmd = [angle_bin]
+            # we start from library, including path and we need only the
+            # test name and the directory where the .so is placed here
+            self._angle_path, lib_name = path.split(self._trace_path)
+            if not lib_name.startswith(self._LIB_PREFIX):
+                raise exceptions.PiglitFatalError(
+                    f'Invalid trace_path: "{self._trace_path}" is not an ANGLE '
+                    'restricted trace library.\n')
+            self._test_name: str = lib_name[len(self._LIB_PREFIX):-len(extension)]
+            # ANGLE names its screenshot after the test, piglit expects it
+            # to be named after the trace instead
+            self._angle_screenshot: str = path.join(
+                self._output_dir, 'angle_vulkan_' + self._test_name + '.png')
+            self._piglit_screenshot: str = path.join(
+                self._output_dir, lib_name + '-.png')
         else:
             raise exceptions.PiglitFatalError(
                 f'Invalid trace_path: "{self._trace_path}" tried to be dumped '
@@ -46,24 +66,13 @@ class ANGLETraceBackend(DumpBackend):
     @dump_handler
     def dump(self):
         '''dumps screenshots'''
-        # we start from library, including path and we need only the test name here
-        lib_name: str = self._trace_path.split("libangle_restricted_traces_")[1]
-        test_name: str = lib_name[:-3]
-
-        # change working directory into where .so is placed
-        angle_path: str = path.dirname(self._trace_path)
-        chdir(angle_path)
-
-        cmd = self._retrace_cmd + ['--one-frame-only',
-                                   '--gtest_filter=TraceTest.' + test_name,
-                                   '--use-angle=vulkan',
-                                   '--screenshot-dir', self._output_dir,
-                                   '--save-screenshots']
-        self._run_logged_command(cmd, None)
-
-        angle_screenshot: str = path.join(self._output_dir, 'angle_vulkan_' + test_name + '.png')
-        piglit_screenshot: str = f'{path.join(self._output_dir, path.basename(self._trace_path))}-.png'
-        rename(angle_screenshot, piglit_screenshot)
+        # run from where .so is placed, without changing our own working
+        # directory, so the output dir must not be relative to it
+        cmd = [*self._retrace_cmd, *self._STATIC_ARGS,
+               f'--gtest_filter=TraceTest.{self._test_name}',
+               '--screenshot-dir', path.abspath(self._output_dir)]
+        self._run_logged_command(cmd, None, cwd=self._angle_path)
+        replace(self._angle_screenshot, self._piglit_screenshot)
 
 
 REGISTRY = Registry(
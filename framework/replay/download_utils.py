@@ -24,8 +24,12 @@
 # SPDX-License-Identifier: MIT
 
 import base64
+import functools
 import hashlib
 import hmac
+import sys
+import threading
+import time
 import xml.etree.ElementTree as ET
 from email.utils import formatdate
 from os import path, remove
@@ -33,7 +37,7 @@ from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 import requests
-from requests.adapters import HTTPAdapter, Retry
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter, Retry
 from requests.structures import CaseInsensitiveDict
 from requests.utils import requote_uri
 
@@ -41,9 +45,70 @@ from framework import core, exceptions
 from framework.replay.local_file_adapter import LocalFileAdapter
 from framework.replay.options import OPTIONS
 
-__all__ = ['ensure_file']
+__all__ = ['download_jobs',
+           'ensure_dirs',
+           'ensure_file']
+
+# Size of the blocks files are read and downloaded in
+_READ_SIZE = 1024 * 1024
+
+# Optional header with the BLAKE2b digest of the file
+BLAKE2B_HEADER = 'x-piglit-blake2b'
+
+# MD5 is only used to check the integrity of the downloads, never for
+# security, so let it bypass the FIPS restrictions when possible.
+if sys.version_info >= (3, 9):
+    _md5 = functools.partial(hashlib.md5, usedforsecurity=False)
+else:
+    _md5 = hashlib.md5
 
 minio_credentials = None
+_minio_credentials_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+
+def _log(file_path: Optional[str], message: str) -> None:
+    """Prints a whole line about a file
+
+    Files are fetched from several threads at once, so anything said about
+    one of them must fit in a single line naming it, or it gets mixed up
+    with what is said about the others.  print() writes the newline on its
+    own, hence the single write of the whole line.
+    """
+    if file_path:
+        line = f"[check_image] {file_path}: {message}\n"
+    else:
+        line = f"[check_image] {message}\n"
+    with _log_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def download_jobs() -> int:
+    """Returns the number of traces to download concurrently"""
+    jobs = core.get_option('PIGLIT_REPLAY_DOWNLOAD_JOBS',
+                           ('replay', 'download_jobs'),
+                           default='8')
+    try:
+        value = int(jobs)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise exceptions.PiglitFatalError(
+            'Invalid number of download jobs "{}", it must be a positive '
+            'integer'.format(jobs))
+
+    return value
+
+
+def _pool_maxsize() -> int:
+    # keep a connection around for each download job, urllib3 silently
+    # drops the ones which don't fit in the pool
+    return max(download_jobs(), DEFAULT_POOLSIZE)
+
+
+def _elapsed_ms(start_time: float) -> float:
+    return round((time.monotonic() - start_time) * 1000, 3)
 
 
 def sign_with_hmac(key, message):
@@ -58,12 +123,19 @@ def sign_with_hmac(key, message):
 def get_minio_credentials(url):
     global minio_credentials
 
-    if minio_credentials is not None:
-        return (minio_credentials['AccessKeyId'],
-                minio_credentials['SecretAccessKey'],
-                minio_credentials['SessionToken'])
+    # Traces may be downloaded from several threads, make sure we only
+    # assume the role once and never hand out partially filled credentials.
+    with _minio_credentials_lock:
+        if minio_credentials is None:
+            minio_credentials = _assume_minio_role()
+
+    return (minio_credentials['AccessKeyId'],
+            minio_credentials['SecretAccessKey'],
+            minio_credentials['SessionToken'])
 
-    minio_credentials = {}
+
+def _assume_minio_role():
+    credentials = {}
 
     params = {'Action': 'AssumeRoleWithWebIdentity',
               'Version': '2011-06-15',
@@ -71,7 +143,7 @@ def get_minio_credentials(url):
               'RoleSessionName': OPTIONS.download['role_session_name'],
               'DurationSeconds': 3600,
               'WebIdentityToken': OPTIONS.download['jwt']}
-    r = requests.post('https://%s' % OPTIONS.download['minio_host'], params=params)
+    r = get_fail_fast_session().post('https://%s' % OPTIONS.download['minio_host'], params=params)
     if r.status_code >= 400:
         print(r.text)
     r.raise_for_status()
@@ -79,15 +151,13 @@ def get_minio_credentials(url):
     root = ET.fromstring(r.text)
     for attr in root.iter():
         if attr.tag == '{https://sts.amazonaws.com/doc/2011-06-15/}AccessKeyId':
-            minio_credentials['AccessKeyId'] = attr.text
+            credentials['AccessKeyId'] = attr.text
         elif attr.tag == '{https://sts.amazonaws.com/doc/2011-06-15/}SecretAccessKey':
-            minio_credentials['SecretAccessKey'] = attr.text
+            credentials['SecretAccessKey'] = attr.text
         elif attr.tag == '{https://sts.amazonaws.com/doc/2011-06-15/}SessionToken':
-            minio_credentials['SessionToken'] = attr.text
+            credentials['SessionToken'] = attr.text
 
-    return (minio_credentials['AccessKeyId'],
-            minio_credentials['SecretAccessKey'],
-            minio_credentials['SessionToken'])
+    return credentials
 
 
 def get_minio_authorization_headers(url, resource):
@@ -149,7 +219,7 @@ def get_chunk_size(
 
 
 def _chunk_size_from_headers(
-    headers: CaseInsensitiveDict, filesize: Optional[int]
+    headers: CaseInsensitiveDict, filesize: Optional[int], file_path: Optional[str]
 ) -> Optional[int]:
     etag = headers.get("etag", "").strip('\"').lower()
     if not etag:
@@ -159,11 +229,11 @@ def _chunk_size_from_headers(
         try:
             filesize = int(headers.get("Content-Length", 0))
         except (ValueError, TypeError):
-            print("Invalid Content-Length header, cannot determine chunk size.")
+            _log(file_path, "Invalid Content-Length header, cannot determine chunk size.")
             return None
 
     if filesize <= 0:
-        print("Content-Length is zero or negative, cannot determine chunk size.")
+        _log(file_path, "Content-Length is zero or negative, cannot determine chunk size.")
         return None
 
     if "-" not in etag:
@@ -174,37 +244,90 @@ def _chunk_size_from_headers(
     return get_chunk_size(filesize, number_of_chunks)
 
 
-def chunk_size_from_headers(headers: CaseInsensitiveDict, filesize: Optional[int] = None) -> int:
+def chunk_size_from_headers(
+    headers: CaseInsensitiveDict,
+    filesize: Optional[int] = None,
+    file_path: Optional[str] = None,
+) -> int:
     """
     Fetch the chunk size from the response headers.
 
     :param headers: The HTTP response headers from S3 or similar services.
     :param filesize: Total size of the file in bytes.
+    :param file_path: The file the headers are about, named in the logs.
 
     :return: The chunk size in bytes, or a default value if not specified.
     """
 
-    chunk_size = _chunk_size_from_headers(headers, filesize)
+    chunk_size = _chunk_size_from_headers(headers, filesize, file_path)
     if chunk_size is None:
-        print("Chunk size not specified in response headers, using default of 5MB.")
+        _log(file_path, "Chunk size not specified in response headers, using default of 5MB.")
         return 5 * 1024 * 1024  # Default to 5MB if not specified
     return chunk_size
 
 
-def calc_etags(inputfile: Path, partsize: int) -> List[str]:
-    '''Calculate e-tag generated by FDO upload script (s3cp).'''
-    md5 = hashlib.md5()
-    md5_digests = []
-    with open(inputfile, 'rb') as file:
-        for chunk in iter(lambda: file.read(partsize), b''):
-            md5.update(chunk)
-            md5_digests.append(hashlib.md5(chunk).digest())
+class _ETagHasher:
+    """Computes the e-tags generated by FDO upload script (s3cp)
+
+    The data can be fed in blocks of any size, independently of the size of
+    the parts it was uploaded in. Both the multipart e-tag and the MD5 of the
+    whole data are computed in a single pass.
+    """
+
+    def __init__(self, partsize: int) -> None:
+        self._partsize = partsize
+        self._part_left = partsize
+        self._part_md5 = _md5()
+        self._part_digests: List[bytes] = []
+        self._md5 = _md5()
+
+    def update(self, data: Any) -> None:
+        self._md5.update(data)
+        view = memoryview(data)
+        while view:
+            size = min(len(view), self._part_left)
+            self._part_md5.update(view[:size])
+            self._part_left -= size
+            view = view[size:]
+            if not self._part_left:
+                self._part_digests.append(self._part_md5.digest())
+                self._part_md5 = _md5()
+                self._part_left = self._partsize
+
+    def etags(self) -> List[str]:
+        md5_digests = list(self._part_digests)
+        if self._part_left != self._partsize:
+            md5_digests.append(self._part_md5.digest())
         return [
-                hashlib.md5(b''.join(md5_digests)).hexdigest() + '-' + str(len(md5_digests)),
-                md5.hexdigest()
+                _md5(b''.join(md5_digests)).hexdigest() + '-' + str(len(md5_digests)),
+                self._md5.hexdigest()
                 ]
 
 
+def _hash_file(inputfile: Path, hasher: Any) -> None:
+    '''Feed the content of a file to a hash object in bounded blocks.'''
+    # Reuse a single buffer, so that the file is never loaded in memory at once
+    buffer = bytearray(_READ_SIZE)
+    view = memoryview(buffer)
+    with open(inputfile, 'rb') as file:
+        for size in iter(lambda: file.readinto(buffer), 0):
+            hasher.update(view[:size])
+
+
+def calc_etags(inputfile: Path, partsize: int) -> List[str]:
+    '''Calculate e-tag generated by FDO upload script (s3cp).'''
+    hasher = _ETagHasher(partsize)
+    _hash_file(inputfile, hasher)
+    return hasher.etags()
+
+
+def calc_blake2b(inputfile: Path) -> str:
+    '''Calculate the BLAKE2b digest of a file.'''
+    hasher = hashlib.blake2b()
+    _hash_file(inputfile, hasher)
+    return hasher.hexdigest()
+
+
 def chase_redirects(session: requests.Session, request: requests.PreparedRequest) -> requests.Response:
     """Finds an HTTP response for a request, with custom redirect chasing
 
@@ -217,26 +340,33 @@ def chase_redirects(session: requests.Session, request: requests.PreparedRequest
     Authorization header, which causes Hetzner's object-storage backend to
     throw a 400.
 
+    The response body is streamed, so the caller is expected to consume it
+    with iter_content() and close the response once done.
+
     :param session: python-requests session object
     :param url: URL to download
     :param headers: Headers to send with the request
     """
 
-    response = session.send(request, allow_redirects=False)
+    response = session.send(request, allow_redirects=False, stream=True)
     if response is None or not response.is_redirect:
         return response
     assert response.next
+    # Release the connection held by the redirect response before following it
+    response.close()
     if "Authorization" in response.next.headers:
         del response.next.headers["Authorization"]
     return chase_redirects(session, response.next)
 
 
-@core.timer_ms
-def download(url: str, file_path: str, headers: Dict[str, str], attempts: int = 2) -> None:
-    """Downloads a URL content into a file
+@functools.lru_cache(maxsize=None)
+def get_session(attempts: int = 2) -> requests.Session:
+    """Returns a session shared by every request to the traces server
+
+    Reusing the same session keeps the connections alive between the
+    downloads of a trace list, instead of doing a new TCP and TLS handshake
+    for each one of them.
 
-    :param url: URL to download
-    :param file_path: Local file name to contain the data downloaded
     :param attempts: Number of attempts
     """
     retries = Retry(
@@ -249,36 +379,68 @@ def download(url: str, file_path: str, headers: Dict[str, str], attempts: int =
     )
     session = requests.Session()
     for protocol in ["http://", "https://"]:
-        adapter = HTTPAdapter(max_retries=retries)
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=_pool_maxsize())
         session.mount(protocol, adapter)
     for protocol in ["file://"]:
         file_adapter = LocalFileAdapter()
         session.mount(protocol, file_adapter)
 
-    md5 = hashlib.md5()
-    local_file_checksums: List[Any] = []
-    md5_digests = []
+    return session
+
+
+@functools.lru_cache(maxsize=None)
+def get_fail_fast_session() -> requests.Session:
+    """Returns a shared session which never retries its requests
+
+    The HEAD requests checking a cached file and the POST fetching the
+    MinIO credentials must fail straight away, the backoff of the download
+    session could keep them waiting for minutes on a server error.
+    """
+    session = requests.Session()
+    for protocol in ["http://", "https://"]:
+        session.mount(protocol, HTTPAdapter(pool_maxsize=_pool_maxsize()))
+    for protocol in ["file://"]:
+        session.mount(protocol, LocalFileAdapter())
+
+    return session
+
+
+def download(url: str, file_path: str, headers: Dict[str, str], attempts: int = 2) -> None:
+    """Downloads a URL content into a file
+
+    :param url: URL to download
+    :param file_path: Local file name to contain the data downloaded
+    :param attempts: Number of attempts
+    """
+    session = get_session(attempts)
+
     request = session.prepare_request(requests.Request(method='GET', url=url, headers=headers))
     with chase_redirects(session, request) as response:
         response.raise_for_status()
-        # chunk_size must be equal to s3cp upload chunk for md5 digest to match
-        chunk_size = chunk_size_from_headers(response.headers)
+        # the part size must be equal to s3cp upload chunk for md5 digest to match
+        hasher = _ETagHasher(chunk_size_from_headers(response.headers, file_path=file_path))
 
         with open(file_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=chunk_size):
+            for chunk in response.iter_content(chunk_size=_READ_SIZE):
                 if chunk:
                     file.write(chunk)
-                    md5.update(chunk)
-                    md5_digests.append(hashlib.md5(chunk).digest())
-            local_file_checksums = [
-                    hashlib.md5(b''.join(md5_digests)).hexdigest() + '-' + str(len(md5_digests)),
-                    md5.hexdigest()
-            ]
+                    hasher.update(chunk)
+        local_file_checksums = hasher.etags()
 
     verify_file_integrity(file_path, response.headers, local_file_checksums)
 
 
 def verify_file_integrity(file_path: str, headers: Any, local_file_checksums: Any) -> None:
+    """
+    :param file_path: path to the local file
+    :param headers: reference to the request
+    :param local_file_checksums: list of already generated MD5
+    """
+    verify_file_checksum(file_path, headers, local_file_checksums)
+    verify_file_size(file_path, headers)
+
+
+def verify_file_checksum(file_path: str, headers: Any, local_file_checksums: Any) -> None:
     """
     :param file_path: path to the local file
     :param headers: reference to the request
@@ -289,56 +451,96 @@ def verify_file_integrity(file_path: str, headers: Any, local_file_checksums: An
         if remote_file_checksum not in local_file_checksums:
             remove(file_path)
             raise exceptions.PiglitFatalError(
-                    f"MD5 checksum {local_file_checksums} "
+                    f"{file_path}: MD5 checksum {local_file_checksums} "
                     f"doesn't match remote ETag MD5 {remote_file_checksum}, removing file..."
             )
     except KeyError:
-        print("ETag is missing from the HTTPS header. "
-              "Fall back to Content-length verification.")
+        _log(file_path, "ETag is missing from the HTTPS header. "
+                        "Fall back to Content-length verification.")
+
 
+def verify_file_size(file_path: str, headers: Any) -> None:
+    """
+    :param file_path: path to the local file
+    :param headers: reference to the request
+    """
     try:
         remote_file_size = int(headers["Content-Length"])
     except KeyError:
-        print("Error getting Content-Length from server. "
-              "Skipping file size check.")
+        _log(file_path, "Error getting Content-Length from server. "
+                        "Skipping file size check.")
         return
 
     local_file_size = path.getsize(file_path)
     if remote_file_size != local_file_size:
         remove(file_path)
         raise exceptions.PiglitFatalError(
-                f"Invalid filesize src {remote_file_size} "
+                f"{file_path}: Invalid filesize src {remote_file_size} "
                 f"doesn't match {local_file_size}, removing file..."
         )
 
 
 def verify_local_file_checksum(url, file_path, headers, destination_file_path):
-    @core.timer_ms
     def check_md5():
-        print(
-            f"[check_image] Verifying already downloaded file {file_path}",
-            end=" ",
-            flush=True,
-        )
-        chunk_size = chunk_size_from_headers(remote_headers, path.getsize(destination_file_path))
-        verify_file_integrity(
+        chunk_size = chunk_size_from_headers(remote_headers,
+                                             path.getsize(destination_file_path),
+                                             file_path)
+        verify_file_checksum(
             destination_file_path, remote_headers, calc_etags(destination_file_path, chunk_size)
         )
 
-    print(f"[check_image] Requesting headers for {file_path}", end=" ", flush=True)
+    def check_blake2b():
+        remote_file_checksum: str = remote_headers[BLAKE2B_HEADER].strip('\"').lower()
+        local_file_checksum = calc_blake2b(destination_file_path)
+        if remote_file_checksum != local_file_checksum:
+            remove(destination_file_path)
+            raise exceptions.PiglitFatalError(
+                    f"{destination_file_path}: BLAKE2b checksum {local_file_checksum} "
+                    f"doesn't match remote BLAKE2b {remote_file_checksum}, removing file..."
+            )
+
     try:
-        response = requests.head(url + file_path, timeout=60, headers=headers)
+        response = get_fail_fast_session().head(url + file_path, timeout=60, headers=headers)
     except requests.exceptions.RequestException as err:
-        print(f"Not verified! HTTP request failed with {err}", flush=True)
+        _log(file_path, "Requesting headers failed. "
+                        f"Not verified! HTTP request failed with {err}")
         return
-    print(
-        f"returned {response.status_code}.",
-        f"Took {response.elapsed.microseconds / 1000} ms",
-        flush=True,
-    )
+    _log(file_path, f"Requesting headers returned {response.status_code}. "
+                    f"Took {response.elapsed.microseconds / 1000} ms")
     remote_headers = response.headers
 
-    check_md5()
+    # Comparing the size is a single stat, so do it before hashing the
+    # whole file and only read it back when the server gave us an ETag.
+    verify_file_size(destination_file_path, remote_headers)
+    # BLAKE2b is cheaper to compute than the MD5 digests making up the
+    # ETag, use it when the server tells us the digest.
+    if BLAKE2B_HEADER in remote_headers:
+        check = check_blake2b
+    elif "etag" in remote_headers:
+        check = check_md5
+    else:
+        _log(file_path, "ETag is missing from the HTTPS header. "
+                        "Skipping MD5 verification.")
+        return
+
+    _log(file_path, "Verifying already downloaded file")
+    start_time = time.monotonic()
+    check()
+    _log(file_path, f"Verified already downloaded file in {_elapsed_ms(start_time)} ms")
+
+
+def ensure_dirs(file_paths):
+    """Creates the directories a list of files will be downloaded into
+
+    Each directory is only created once, however many of the files it holds.
+
+    :param file_paths: paths of the files, relative to the traces db
+    """
+    if OPTIONS.download['url'] is None:
+        return
+
+    for dirname in {path.dirname(path.join(OPTIONS.db_path, p)) for p in file_paths}:
+        core.check_dir(dirname)
 
 
 def ensure_file(file_path):
@@ -354,7 +556,10 @@ def ensure_file(file_path):
     if OPTIONS.download['caching_proxy_url'] is not None:
         url = OPTIONS.download['caching_proxy_url'].geturl() + url
 
-    core.check_dir(path.dirname(destination_file_path))
+    # the directory is normally created upfront by ensure_dirs()
+    destination_dir = path.dirname(destination_file_path)
+    if not path.isdir(destination_dir):
+        core.check_dir(destination_dir)
 
     if OPTIONS.download['minio_host']:
         assert OPTIONS.download['minio_bucket']
@@ -370,6 +575,7 @@ def ensure_file(file_path):
         verify_local_file_checksum(url, file_path, headers, destination_file_path)
         return
 
-    print(f"[check_image] Downloading file {file_path}", end=" ", flush=True)
-
+    _log(file_path, "Downloading file")
+    start_time = time.monotonic()
     download(url + file_path, destination_file_path, headers)
+    _log(file_path, f"Downloaded file in {_elapsed_ms(start_time)} ms")
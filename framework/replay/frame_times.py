@@ -24,13 +24,14 @@
 # SPDX-License-Identifier: MIT
 
 import json  # type: ignore
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import path
 
 from framework import status
 from framework.replay import backends
 from framework.replay import query_traces_yaml as qty
 from framework.replay.backends.apitrace import APITraceBackend
-from framework.replay.download_utils import ensure_file
+from framework.replay.download_utils import download_jobs, ensure_dirs, ensure_file
 from framework.replay.options import OPTIONS
 
 __all__ = ['from_yaml',
@@ -55,8 +56,6 @@ def _replay(trace_path):
 
 
 def _run_trace(trace_path):
-    ensure_file(trace_path)
-
     json_result = {}
 
     frame_times = _replay(path.join(OPTIONS.db_path, trace_path))
@@ -79,8 +78,9 @@ def _print_result(result, trace_path, json_result):
     output = 'PIGLIT: '
     json_result['result'] = str(result)
 
-    output += json.dumps(json_result)
-    print(output)
+    # frame_times may hold thousands of entries, keep the line compact
+    output += json.dumps(json_result, separators=(',', ':'))
+    print(output, flush=True)
 
 
 def from_yaml(yaml_file):
@@ -91,18 +91,36 @@ def from_yaml(yaml_file):
     global_result = status.PASS
     # TODO: print in subtest format
     # json_results = {}
-    t_list = qty.traces(y, trace_extensions=".trace", device_name=OPTIONS.device_name)
-    for t in t_list:
-        result, json_result = _run_trace(t['path'])
+    # only the paths are needed to profile, flatten them out of the YAML once
+    trace_paths = [t['path'] for t in qty.traces(y, trace_extensions=".trace",
+                                                 device_name=OPTIONS.device_name)]
+
+    # Downloads are network bound, so fetch all the traces concurrently
+    # before profiling them one after the other.
+    ensure_dirs(trace_paths)
+    with ThreadPoolExecutor(max_workers=download_jobs()) as executor:
+        futures = [executor.submit(ensure_file, p) for p in trace_paths]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        finally:
+            # Report a failing trace straight away instead of waiting for
+            # all the others to be downloaded.
+            for future in futures:
+                future.cancel()
+
+    for trace_path in trace_paths:
+        result, json_result = _run_trace(trace_path)
         if result is not status.PASS and global_result is not status.CRASH:
             global_result = result
         # json_results.update(json_result)
-        # _print_result(result, t['path'], json_result)
+        # _print_result(result, trace_path, json_result)
 
     return global_result
 
 
 def trace(trace_path):
+    ensure_file(trace_path)
     result, json_result = _run_trace(trace_path)
     _print_result(result, trace_path, json_result)
 
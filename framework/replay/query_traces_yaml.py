@@ -24,27 +24,81 @@
 # SPDX-License-Identifier: MIT
 
 
+import os
+import stat
 from os import path
-from typing import Any, Generator, Optional, Union
+from typing import Any, Dict, Generator, Optional, Tuple, Union
 
 import yaml
 
 from framework import exceptions
 
+try:
+    # Use the libyaml based parser when PyYAML was built with it.
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader  # type: ignore
+
 __all__ = ['download_url',
            'load_yaml',
            'trace_checksum',
            'traces']
 
 
-def load_yaml(y):
+def _parse_yaml(y):
     try:
-        return yaml.safe_load(y) or {}
+        return yaml.load(y, Loader=_SafeLoader) or {}
     except yaml.YAMLError:
         raise exceptions.PiglitFatalError(
             'Cannot use the provided stream. Is it YAML?')
 
 
+# parsed YAML files, by absolute path, along with their mtime when parsed
+_YAML_FILES: Dict[str, Tuple[int, Any]] = {}
+_YAML_FILES_MAX = 32
+
+
+def _yaml_file_key(y: Any) -> Optional[Tuple[str, int]]:
+    '''returns the (path, mtime) a not yet read YAML file is cached with'''
+    try:
+        if not isinstance(y.name, str) or y.tell() != 0:
+            return None
+        st = os.fstat(y.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+
+    if not stat.S_ISREG(st.st_mode):
+        return None
+
+    return path.abspath(y.name), st.st_mtime_ns
+
+
+def load_yaml(y):
+    '''parses the YAML document from a string or a stream
+
+    The result of parsing a regular file is cached until the file is
+    modified, so the returned data must be treated as read-only.
+    '''
+    key = _yaml_file_key(y)
+    if key is None:
+        return _parse_yaml(y)
+
+    filename, mtime_ns = key
+    cached = _YAML_FILES.get(filename)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+
+    # parse the stream we were given, the path may point to another file by
+    # now if it was replaced after being opened
+    data = _parse_yaml(y)
+    _YAML_FILES.pop(filename, None)
+    if len(_YAML_FILES) >= _YAML_FILES_MAX:
+        del _YAML_FILES[next(iter(_YAML_FILES))]
+    _YAML_FILES[filename] = (mtime_ns, data)
+
+    return data
+
+
 def trace_checksum(trace: Any, device_name: Optional[str]) -> str:
     '''returns checksum of trace'''
     try:
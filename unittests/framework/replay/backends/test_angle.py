@@ -0,0 +1,99 @@
+# coding=utf-8
+#
+# Copyright © Collabora Ltd.
+# SPDX-License-Identifier: MIT
+
+
+"""Tests for replayer's ANGLE backend."""
+
+import pytest
+
+import os
+import subprocess
+import sys
+
+from os import path
+
+from framework import exceptions
+from framework.replay import backends
+from framework.replay.options import OPTIONS
+
+
+class TestANGLETraceBackend(object):
+    """Tests for the ANGLETraceBackend class."""
+
+    def mock_angle_subprocess_run(self, cmd, stdout, stderr, env=None, cwd=None):
+        screenshot_dir = cmd[cmd.index('--screenshot-dir') + 1]
+        test_name = next(arg for arg in cmd
+                         if arg.startswith('--gtest_filter=')).split('TraceTest.')[1]
+        with open(path.join(screenshot_dir,
+                            'angle_vulkan_' + test_name + '.png'), 'w') as f:
+            f.write('PNG')
+        return subprocess.CompletedProcess(cmd, 0, b'')
+
+    @pytest.fixture(autouse=True)
+    def setup(self, mocker, tmpdir):
+        """Setup for TestANGLETraceBackend.
+
+        This create the basic environment for testing.
+        """
+
+        OPTIONS.device_name = 'test-device'
+        self.angle_bin = '/env/angle_trace_tests'
+        self.angle_path = tmpdir.mkdir('angle').strpath
+        self.trace_path = path.join(self.angle_path,
+                                    'libangle_restricted_traces_minetest.so')
+        self.output_dir = tmpdir.mkdir('results').strpath
+        self.m_angle_subprocess_run = mocker.patch(
+            'framework.replay.backends.abstract.subprocess.run',
+            side_effect=self.mock_angle_subprocess_run)
+        self.mocker = mocker
+        mocker.patch.dict('os.environ')
+        os.environ['PIGLIT_REPLAY_ANGLE_BINARY'] = self.angle_bin
+
+    @pytest.mark.raises(exception=exceptions.PiglitFatalError)
+    def test_init_unsupported_trace(self):
+        """Tests for the init method.
+
+        Should raise an exception in case of creating with an unsupported trace
+        format.
+
+        """
+        test = backends.angle.ANGLETraceBackend('unsupported_trace.gfxr')
+
+    @pytest.mark.raises(exception=exceptions.PiglitFatalError)
+    def test_init_not_a_restricted_trace(self):
+        """Tests for the init method.
+
+        Should raise an exception in case of creating with a library which is
+        not an ANGLE restricted trace.
+
+        """
+        test = backends.angle.ANGLETraceBackend('libfoo.so')
+
+    def test_dump(self):
+        """Tests for the dump method.
+
+        Check the trace is replayed from the directory holding the library,
+        without changing our own working directory, and its screenshot is
+        renamed as piglit expects it.
+
+        """
+        cwd = os.getcwd()
+        test = backends.angle.ANGLETraceBackend(self.trace_path,
+                                                output_dir=self.output_dir)
+        assert test.dump()
+        assert os.getcwd() == cwd
+        self.m_angle_subprocess_run.assert_called_once_with(
+            [self.angle_bin, '--one-frame-only',
+             '--use-angle=vulkan',
+             '--save-screenshots',
+             '--gtest_filter=TraceTest.minetest',
+             '--screenshot-dir', self.output_dir],
+            stdout=subprocess.PIPE, stderr=sys.stderr, env=None,
+            cwd=self.angle_path)
+        assert not path.exists(path.join(self.output_dir,
+                                         'angle_vulkan_minetest.png'))
+        assert path.exists(path.join(
+            self.output_dir,
+            'libangle_restricted_traces_minetest.so-.png'))
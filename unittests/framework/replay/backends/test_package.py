@@ -57,7 +57,9 @@ def mock_backend(mocker, backend):
             extensions=['.test_backend'],
             backend=backend,
         )})
+    backends._lookup.cache_clear()
     yield
+    backends._lookup.cache_clear()
 
 
 # Tests
@@ -26,7 +26,12 @@
 
 """Tests for replayer's download_utils module."""
 
+import functools
+import hashlib
 import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from contextlib import nullcontext as does_not_raise
 from dataclasses import dataclass
@@ -65,14 +70,26 @@ class MockedResponseData:
 
 @dataclass(frozen=True)
 class MockedResponse:
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def digests():
+        # Hashing the mocked file is the costly part of building the header
+        # scenarios, only do it once for the whole test session
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dummy_path = Path(tmp_dir, "dummy_file")
+            dummy_path.write_bytes(MockedResponseData.binary_data)
+            etag, full_etags = download_utils.calc_etags(dummy_path, 5 * 1024 * 1024)
+            blake2b = download_utils.calc_blake2b(dummy_path)
+
+        return etag, full_etags, blake2b
+
     @staticmethod
     def header_scenarios():
         length: dict[str, Any] = {
             "Content-Length": str(len(MockedResponseData.binary_data))
         }
-        dummy_path = Path("dummy_file")
-        with MockedResponse.create_local_file(dummy_path, MockedResponseData.binary_data):
-            etag, full_etags = download_utils.calc_etags(dummy_path, 5 * 1024 * 1024)
+        etag, full_etags, blake2b_digest = MockedResponse.digests()
+        blake2b = {download_utils.BLAKE2B_HEADER: blake2b_digest}
 
         return {
             "With Content-Length": length,
@@ -80,6 +97,8 @@ class MockedResponse:
             "With full etags": {"etag": full_etags},
             "With Content-Length and etag": {**length, "etag": etag},
             "With Content-Length and full etags": {**length, "etag": full_etags},
+            "With BLAKE2b": blake2b,
+            "With Content-Length, etag and BLAKE2b": {**length, "etag": etag, **blake2b},
             "Without integrity headers": {},
         }
 
@@ -91,16 +110,6 @@ class MockedResponse:
             "already has wrong file": b"obsolete/corrupted data",
         }
 
-    @staticmethod
-    @contextmanager
-    def create_local_file(trace_file, data):
-        data = data or MockedResponseData.binary_data
-        trace_path = Path(trace_file)
-        trace_path.write_bytes(data)
-        yield
-        if trace_path.exists():
-            trace_path.unlink()
-
 
 class TestDownloadUtils(object):
     """Tests for download_utils methods."""
@@ -129,6 +138,14 @@ class TestDownloadUtils(object):
         # Make sure the temporary directory exists
         os.makedirs(path.dirname(self.trace_file), exist_ok=True)
 
+    @pytest.fixture
+    def create_local_file(self, prepare_trace_file):
+        # The trace file lives in tmpdir, pytest takes care of removing it
+        def inner(data):
+            Path(self.trace_file).write_bytes(data or MockedResponseData.binary_data)
+
+        return inner
+
     @pytest.fixture
     def create_mock_response(self, requests_mock):
         def inner(url, headers):
@@ -167,6 +184,24 @@ class TestDownloadUtils(object):
         download_utils.ensure_file(self.trace_path)
         TestDownloadUtils.check_same_file(self.trace_file, "remote")
 
+    def test_ensure_dirs(self, mocker):
+        """download_utils.ensure_dirs: Check each directory gets created only once"""
+
+        m_check_dir = mocker.patch('framework.replay.download_utils.core.check_dir',
+                                   wraps=download_utils.core.check_dir)
+        other_trace_path = path.join(path.dirname(self.trace_path), 'other.gfxr')
+        download_utils.ensure_dirs([self.trace_path, other_trace_path])
+        m_check_dir.assert_called_once_with(path.dirname(self.trace_file))
+        assert path.isdir(path.dirname(self.trace_file))
+
+    def test_ensure_dirs_no_url(self):
+        """download_utils.ensure_dirs: Check nothing gets created when there is
+        nothing to download"""
+
+        OPTIONS.set_download_url("")
+        download_utils.ensure_dirs([self.trace_path])
+        assert not path.exists(path.dirname(self.trace_file))
+
     @pytest.mark.raises(exception=exceptions.PiglitFatalError)
     def test_ensure_file_not_exists_no_url(self):
         """download_utils.ensure_file: Check an exception raises when not passing an URL for a non existing file"""
@@ -208,21 +243,134 @@ class TestDownloadUtils(object):
         ids=MockedResponse.header_scenarios().keys(),
     )
     def test_ensure_file_checks_integrity(
-        self, prepare_trace_file, create_mock_response, headers, stored_data
+        self, create_local_file, create_mock_response, headers, stored_data
     ):
         create_mock_response(self.full_url, headers)
-        with MockedResponse.create_local_file(self.trace_file, stored_data):
-            stored_file_is_wrong: bool = (
-                self.trace_file.check()
-                and self.trace_file.read() != MockedResponseData.binary_data.decode()
-            )
-            expectation = (
-                pytest.raises(exceptions.PiglitFatalError)
-                if headers and stored_file_is_wrong
-                else does_not_raise()
-            )
-            with expectation:
-                download_utils.ensure_file(self.trace_path)
+        create_local_file(stored_data)
+        stored_file_is_wrong: bool = (
+            self.trace_file.check()
+            and self.trace_file.read() != MockedResponseData.binary_data.decode()
+        )
+        expectation = (
+            pytest.raises(exceptions.PiglitFatalError)
+            if headers and stored_file_is_wrong
+            else does_not_raise()
+        )
+        with expectation:
+            download_utils.ensure_file(self.trace_path)
+
+    def test_ensure_file_valid_cache_skips_get(self,
+                                               requests_mock,
+                                               create_local_file,
+                                               create_mock_response):
+        """download_utils.ensure_file: Check a cached file matching the
+        remote headers is verified with a HEAD request only"""
+
+        headers = MockedResponse.header_scenarios()["With Content-Length and etag"]
+        create_mock_response(self.full_url, headers)
+        create_local_file(MockedResponseData.binary_data)
+        download_utils.ensure_file(self.trace_path)
+        assert Path(self.trace_file).exists()
+
+        methods = [r.method for r in requests_mock.request_history]
+        assert methods == ['HEAD']
+
+    def test_ensure_file_prefers_blake2b(self,
+                                         mocker,
+                                         create_local_file,
+                                         create_mock_response):
+        """download_utils.ensure_file: Check a cached file is verified with
+        BLAKE2b rather than MD5 when the server provides its digest"""
+
+        headers = MockedResponse.header_scenarios()["With Content-Length, etag and BLAKE2b"]
+        create_mock_response(self.full_url, headers)
+        m_calc_etags = mocker.patch('framework.replay.download_utils.calc_etags')
+        create_local_file(MockedResponseData.binary_data)
+        download_utils.ensure_file(self.trace_path)
+        assert Path(self.trace_file).exists()
+        m_calc_etags.assert_not_called()
+
+    @pytest.mark.raises(exception=exceptions.PiglitFatalError)
+    def test_ensure_file_wrong_size_skips_hashing(self,
+                                                  mocker,
+                                                  prepare_trace_file,
+                                                  create_mock_response):
+        """download_utils.ensure_file: Check a cached file with the wrong
+        size is rejected without hashing it"""
+
+        headers = MockedResponse.header_scenarios()["With Content-Length and etag"]
+        create_mock_response(self.full_url, headers)
+        m_calc_etags = mocker.patch('framework.replay.download_utils.calc_etags')
+        self.trace_file.write("local")
+        try:
+            download_utils.ensure_file(self.trace_path)
+        finally:
+            m_calc_etags.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "stored_data",
+        [None, MockedResponseData.binary_data],
+        ids=["nothing stored", "already has file"],
+    )
+    @pytest.mark.parametrize(
+        "headers",
+        [MockedResponse.header_scenarios()["With etag"],
+         MockedResponse.header_scenarios()["Without integrity headers"]],
+        ids=["With etag", "Without integrity headers"],
+    )
+    def test_ensure_file_logs_whole_lines(self,
+                                          capsys,
+                                          create_local_file,
+                                          create_mock_response,
+                                          headers,
+                                          stored_data):
+        """download_utils.ensure_file: Check every line logged names the file,
+        so the logs of files fetched concurrently can't get mixed up"""
+
+        create_mock_response(self.full_url, headers)
+        if stored_data is not None:
+            create_local_file(stored_data)
+        download_utils.ensure_file(self.trace_path)
+
+        lines = capsys.readouterr().out.splitlines()
+        assert lines
+        for line in lines:
+            assert line.startswith('[check_image] ')
+            assert self.trace_path in line
+
+    def test_ensure_file_logs_from_threads(self, mocker, create_mock_response):
+        """download_utils.ensure_file: Check the files fetched and verified
+        from several threads are logged one whole line at a time"""
+
+        class SlowStream:
+            """Yields to the other threads in between writes"""
+
+            def __init__(self):
+                self.writes = []
+
+            def write(self, data):
+                self.writes.append(data)
+                time.sleep(0.001)
+
+            def flush(self):
+                pass
+
+        headers = MockedResponse.header_scenarios()["With Content-Length and etag"]
+        trace_paths = [f'd{i % 3}/t{i}.trace' for i in range(12)]
+        for trace_path in trace_paths:
+            create_mock_response(self.url + trace_path, headers)
+        download_utils.ensure_dirs(trace_paths)
+        stream = mocker.patch('sys.stdout', new_callable=SlowStream)
+
+        # download, then verify the cached files
+        for _ in range(2):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(download_utils.ensure_file, trace_paths))
+
+        assert stream.writes
+        for data in stream.writes:
+            assert data.startswith('[check_image] ')
+            assert data.count('\n') == 1 and data.endswith('\n')
 
     @pytest.mark.raises(exception=exceptions.PiglitFatalError)
     def test_download_with_invalid_content_length(self,
@@ -262,6 +410,49 @@ class TestDownloadUtils(object):
         download_utils.download(self.full_url, self.trace_file, None)
         assert Path(self.trace_file).exists()
 
+    def test_download_reuses_session(self):
+        """download_utils.get_session: Check the session and its retrying
+        adapters are shared between requests"""
+
+        session = download_utils.get_session()
+        assert session is download_utils.get_session()
+        adapter = session.get_adapter(self.full_url)
+        assert adapter.max_retries.connect == 2
+        assert 503 in adapter.max_retries.status_forcelist
+
+    @pytest.mark.parametrize("jobs, pool_maxsize", [
+        ("4", requests.adapters.DEFAULT_POOLSIZE),
+        ("32", 32),
+    ])
+    def test_sessions_pool_fits_download_jobs(self, mocker, jobs, pool_maxsize):
+        """download_utils.get_session: Check the sessions keep a connection
+        for each of the concurrent download jobs"""
+
+        mocker.patch.dict('os.environ', {'PIGLIT_REPLAY_DOWNLOAD_JOBS': jobs})
+        for get_session in (download_utils.get_session,
+                            download_utils.get_fail_fast_session):
+            get_session.cache_clear()
+            try:
+                adapter = get_session().get_adapter(self.full_url)
+                assert adapter.poolmanager.connection_pool_kw['maxsize'] == pool_maxsize
+            finally:
+                get_session.cache_clear()
+
+    def test_head_does_not_retry(self, requests_mock, create_local_file):
+        """download_utils.ensure_file: Check verifying a cached file fails
+        straight away on a server error instead of backing off"""
+
+        session = download_utils.get_fail_fast_session()
+        assert session is download_utils.get_fail_fast_session()
+        adapter = session.get_adapter(self.full_url)
+        assert adapter.max_retries.total == 0
+        assert not adapter.max_retries.status_forcelist
+
+        requests_mock.head(self.full_url, status_code=503)
+        create_local_file(MockedResponseData.binary_data)
+        download_utils.ensure_file(self.trace_path)
+        assert [r.method for r in requests_mock.request_history] == ['HEAD']
+
     def test_download_without_content_length(self,
                                              requests_mock,
                                              prepare_trace_file):
@@ -277,6 +468,21 @@ class TestDownloadUtils(object):
         download_utils.download(self.full_url, self.trace_file, None)
         assert Path(self.trace_file).exists()
 
+    def test_download_streams_content(self,
+                                      requests_mock,
+                                      create_mock_response,
+                                      prepare_trace_file):
+        """download_utils.download: Check the body is streamed to disk and
+        verified against the etag without buffering it first"""
+
+        headers = MockedResponse.header_scenarios()["With Content-Length and etag"]
+        create_mock_response(self.full_url, headers)
+
+        assert not self.trace_file.check()
+        download_utils.download(self.full_url, self.trace_file, None)
+        assert requests_mock.last_request.stream
+        assert Path(self.trace_file).read_bytes() == MockedResponseData.binary_data
+
     def test_minio_authorization(self, requests_mock):
         """download_utils.ensure_file: Check we send the authentication headers to MinIO"""
         requests_mock.post(self.url, text=ASSUME_ROLE_RESPONSE)
@@ -343,3 +549,34 @@ class TestGetChunkSize(object):
         """get_chunk_size: Test various filesize and chunk combinations"""
         result = download_utils.get_chunk_size(filesize, number_of_chunks)
         assert result == expected_chunk_size, f"Expected {expected_chunk_size / 1024 / 1024} MB but got {result / 1024 / 1024} MB"
+
+
+class TestCalcEtags(object):
+    """Tests for calc_etags function."""
+
+    @pytest.mark.parametrize("partsize", [
+        5 * 1024 * 1024,
+        1024 * 1024,
+        1000,
+        len(MockedResponseData.binary_data),
+        2 * len(MockedResponseData.binary_data),
+    ], ids=[
+        "5mb_parts",
+        "read_size_parts",
+        "unaligned_parts",
+        "single_part",
+        "part_bigger_than_file",
+    ])
+    def test_calc_etags(self, tmp_path, partsize):
+        """calc_etags: Check the e-tags don't depend on the file read size"""
+        data = MockedResponseData.binary_data
+        parts = [data[i:i + partsize] for i in range(0, len(data), partsize)]
+        expected = [
+            hashlib.md5(b''.join(hashlib.md5(p).digest() for p in parts)).hexdigest()
+            + '-' + str(len(parts)),
+            hashlib.md5(data).hexdigest(),
+        ]
+
+        trace_file = tmp_path / "trace"
+        trace_file.write_bytes(data)
+        assert download_utils.calc_etags(trace_file, partsize) == expected
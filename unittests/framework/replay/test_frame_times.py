@@ -26,18 +26,27 @@
 
 """Tests for replayer's frame_times module."""
 
-import contextlib
-import io
+import json
+import os
+import time
 from os import path
 from subprocess import CompletedProcess
 
 import pytest
 
-from framework import exceptions, status
+from framework import core, exceptions, status
 from framework.replay import backends, frame_times
 from framework.replay.options import OPTIONS
 
 
+@pytest.fixture
+def config(mocker):
+    conf = mocker.patch('framework.core.PIGLIT_CONFIG',
+                        new_callable=core.PiglitConfig)
+    conf.add_section('replay')
+    yield conf
+
+
 class TestFrameTimes(object):
     """Tests for frame_times methods."""
 
@@ -48,7 +57,8 @@ class TestFrameTimes(object):
         backends.apitrace._run_command(self._cmd.args, self._env)
         if trace_path.endswith('KhronosGroup-Vulkan-Tools/amd/polaris10/vkcube.gfxr'):
             return None
-        elif trace_path.endswith('pathfinder/demo.trace'):
+        elif trace_path.endswith(('pathfinder/demo.trace',
+                                  'pathfinder/canvas_moving.trace')):
             return [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
         else:
             raise exceptions.PiglitFatalError(
@@ -87,7 +97,32 @@ class TestFrameTimes(object):
                     }
                 }
             }}
-
+        elif yaml_file == 'two-apitraces.yml':
+            return {"traces": {
+                "pathfinder/demo.trace": {
+                    OPTIONS.device_name: {
+                        "checksum": "e624d76c70cc3c532f4f54439e13659a"
+                    }
+                },
+                "pathfinder/canvas_moving.trace": {
+                    OPTIONS.device_name: {
+                        "checksum": "0ab8cbbd5fc8b1575ebc4e35a0a43e5f"
+                    }
+                }
+            }}
+        elif yaml_file == 'many-apitraces.yml':
+            return {"traces": {
+                "pathfinder/demo.trace": {
+                    OPTIONS.device_name: {
+                        "checksum": "e624d76c70cc3c532f4f54439e13659a"
+                    }
+                },
+                **{f"pathfinder/canvas_moving-{i}.trace": {
+                    OPTIONS.device_name: {
+                        "checksum": "0ab8cbbd5fc8b1575ebc4e35a0a43e5f"
+                    }
+                } for i in range(8)}
+            }}
         else:
             raise exceptions.PiglitFatalError(
                 'Non treated YAML file: {}'.format(yaml_file))
@@ -122,68 +157,116 @@ class TestFrameTimes(object):
             "framework.replay.frame_times.APITraceBackend.profile",
             side_effect=self.mock_profile,
         )
+        self.m_executor = mocker.patch(
+            'framework.replay.frame_times.ThreadPoolExecutor',
+            wraps=frame_times.ThreadPoolExecutor)
+        mocker.patch.dict('os.environ')
+        os.environ.pop('PIGLIT_REPLAY_DOWNLOAD_JOBS', None)
         self.tmpdir = tmpdir
 
-    def test_from_yaml_empty(self):
+    def test_from_yaml_empty(self, capsys):
         """frame_times.from_yaml: profile using an empty YAML file"""
 
-        f = io.StringIO()
-        with contextlib.redirect_stdout(f):
-            assert (frame_times.from_yaml('empty.yml')
-                    is status.PASS)
+        assert (frame_times.from_yaml('empty.yml')
+                is status.PASS)
         self.m_qty_load_yaml.assert_called_once()
-        s = f.getvalue()
+        s = capsys.readouterr().out
         assert s == ''
 
     @pytest.mark.parametrize("trace_path", ["one-trace.yml", "two-traces.yml"])
-    def test_from_yaml_traces(self, trace_path):
+    def test_from_yaml_traces(self, trace_path, capsys):
         """frame_times.from_yaml: profile using a YAML files with one or more trace path"""
 
-        f = io.StringIO()
-        with contextlib.redirect_stdout(f):
-            assert frame_times.from_yaml(trace_path) is status.PASS
+        assert frame_times.from_yaml(trace_path) is status.PASS
         self.m_qty_load_yaml.assert_called_once()
-        self.m_ensure_file.assert_called_once()
+        self.m_ensure_file.assert_called_once_with(self.trace_path)
         self.m_profile.assert_called_once()
-        s: list[str] = f.getvalue().splitlines()
+        s: list[str] = capsys.readouterr().out.splitlines()
         assert s[-1] == f"[frame_times] {len(self.exp_frame_times)}"
 
-    def test_trace_success(self):
+    def test_from_yaml_several_traces(self, capsys):
+        """frame_times.from_yaml: download every trace for the device before
+        profiling them one after the other"""
+
+        trace_paths = ['pathfinder/demo.trace', 'pathfinder/canvas_moving.trace']
+        assert frame_times.from_yaml('two-apitraces.yml') is status.PASS
+        self.m_qty_load_yaml.assert_called_once()
+        assert sorted(c.args for c in self.m_ensure_file.call_args_list) == \
+            sorted((p,) for p in trace_paths)
+        assert [c.args for c in self.m_profile.call_args_list] == \
+            [(path.join(OPTIONS.db_path, p),) for p in trace_paths]
+        s = capsys.readouterr().out.splitlines()
+        assert [l for l in s if l.startswith('[frame_times]')] == \
+            [f"[frame_times] {len(self.exp_frame_times)}"] * 2
+
+    def test_from_yaml_download_failure(self):
+        """frame_times.from_yaml: stop downloading the traces as soon as one
+        of them fails, even while an earlier one is still being fetched"""
+
+        def mock_ensure_file(trace_path):
+            if trace_path == 'pathfinder/demo.trace':
+                time.sleep(0.3)
+            elif trace_path == 'pathfinder/canvas_moving-0.trace':
+                raise exceptions.PiglitFatalError('download failed')
+            else:
+                time.sleep(0.05)
+
+        self.m_ensure_file.side_effect = mock_ensure_file
+        os.environ['PIGLIT_REPLAY_DOWNLOAD_JOBS'] = '2'
+        with pytest.raises(exceptions.PiglitFatalError):
+            frame_times.from_yaml('many-apitraces.yml')
+        assert self.m_ensure_file.call_count <= 3
+        self.m_profile.assert_not_called()
+
+    def test_from_yaml_download_jobs_config(self, config):
+        """frame_times.from_yaml: the download jobs are read from piglit.conf
+        once it is loaded, not when the module is imported"""
+
+        config.set('replay', 'download_jobs', '3')
+        assert frame_times.from_yaml('one-trace.yml') is status.PASS
+        self.m_executor.assert_called_once_with(max_workers=3)
+
+    @pytest.mark.parametrize("jobs", ["0", "-1", "many"])
+    @pytest.mark.raises(exception=exceptions.PiglitFatalError)
+    def test_from_yaml_invalid_download_jobs(self, jobs):
+        """frame_times.from_yaml: an invalid number of download jobs is a
+        fatal error"""
+
+        os.environ['PIGLIT_REPLAY_DOWNLOAD_JOBS'] = jobs
+        frame_times.from_yaml('one-trace.yml')
+
+    def test_trace_success(self, capsys):
         """frame_times.trace: profile a trace successfully"""
 
-        f = io.StringIO()
-        with contextlib.redirect_stdout(f):
-            assert (frame_times.trace(self.trace_path)
-                    is status.PASS)
+        assert (frame_times.trace(self.trace_path)
+                is status.PASS)
         self.m_qty_load_yaml.assert_not_called()
         self.m_ensure_file.assert_called_once()
         self.m_profile.assert_called_once()
-        s = f.getvalue()
-        assert s.endswith('PIGLIT: '
-                          '{"images": [{'
-                          '"image_desc": "' + self.trace_path + '", '
-                          '"frame_times": ' + str(self.exp_frame_times) +
-                          '}], "result": "pass"}\n')
-
-    def test_trace_fail(self):
+        s = capsys.readouterr().out.splitlines()
+        assert s[-1].startswith('PIGLIT: ')
+        assert json.loads(s[-1][len('PIGLIT: '):]) == {
+            "images": [{"image_desc": self.trace_path,
+                        "frame_times": self.exp_frame_times}],
+            "result": "pass"}
+
+    def test_trace_fail(self, capsys):
         """frame_times.trace: fail profiling a trace"""
 
         fail_trace_path = "KhronosGroup-Vulkan-Tools/amd/polaris10/vkcube.gfxr"
-        f = io.StringIO()
-        with contextlib.redirect_stdout(f):
-            assert (frame_times.trace(fail_trace_path)
-                    is status.CRASH)
+        assert (frame_times.trace(fail_trace_path)
+                is status.CRASH)
         self.m_qty_load_yaml.assert_not_called()
         self.m_ensure_file.assert_called_once()
         self.m_profile.assert_called_once()
-        s = f.getvalue()
-        assert s.endswith('PIGLIT: '
-                          '{"images": [{'
-                          '"image_desc": "' + fail_trace_path + '", '
-                          '"frame_times": null'
-                          '}], "result": "crash"}\n')
-
-    def test_trace_crash_log_output(self, tmp_path):
+        s = capsys.readouterr().out.splitlines()
+        assert s[-1].startswith('PIGLIT: ')
+        assert json.loads(s[-1][len('PIGLIT: '):]) == {
+            "images": [{"image_desc": fail_trace_path,
+                        "frame_times": None}],
+            "result": "crash"}
+
+    def test_trace_crash_log_output(self, tmp_path, capsys):
         """frame_times.trace: profile a trace with a crash, check for inner
         command output logs"""
         stderr_msg = b"stderr message"
@@ -191,10 +274,9 @@ class TestFrameTimes(object):
 
         self._cmd = CompletedProcess(self._cmd.args, 1, stdout_msg, stderr_msg)
 
-        f = io.StringIO()
-        with contextlib.redirect_stdout(f), pytest.raises(RuntimeError):
+        with pytest.raises(RuntimeError):
             assert frame_times.trace(self.trace_path) is status.CRASH
 
-        s = f.getvalue()
+        s = capsys.readouterr().out
         assert stderr_msg.decode() in s
         assert stdout_msg.decode() in s
@@ -25,6 +25,8 @@
 
 """Tests for replayer's query_traces_yaml module."""
 
+import os
+
 import pytest
 
 from framework import exceptions
@@ -93,6 +95,45 @@ def test_load_yaml_basic():
         assert i[1] == y
 
 
+def test_load_yaml_file_cached(mocker, tmp_path):
+    """query_traces_yaml.load_yaml: Parse a YAML file only once until it
+    gets modified"""
+
+    mocker.patch.dict(qty._YAML_FILES, clear=True)
+    m_load = mocker.patch('framework.replay.query_traces_yaml.yaml.load',
+                          wraps=qty.yaml.load)
+    yaml_file = tmp_path / 'traces.yml'
+    yaml_file.write_text(YAML_DATA[2][0])
+
+    for _ in range(2):
+        with open(yaml_file, 'r') as f:
+            assert qty.load_yaml(f) == YAML_DATA[2][1]
+    m_load.assert_called_once()
+
+    yaml_file.write_text(YAML_DATA[1][0])
+    st = yaml_file.stat()
+    os.utime(yaml_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    with open(yaml_file, 'r') as f:
+        assert qty.load_yaml(f) == YAML_DATA[1][1]
+    assert m_load.call_count == 2
+    assert len(qty._YAML_FILES) == 1
+
+
+def test_load_yaml_file_replaced(mocker, tmp_path):
+    """query_traces_yaml.load_yaml: Parse the stream given rather than the
+    file its path points to when it was replaced after being opened"""
+
+    mocker.patch.dict(qty._YAML_FILES, clear=True)
+    yaml_file = tmp_path / 'traces.yml'
+    yaml_file.write_text(YAML_DATA[2][0])
+    new_file = tmp_path / 'traces.yml.new'
+    new_file.write_text(YAML_DATA[1][0])
+
+    with open(yaml_file, 'r') as f:
+        os.replace(new_file, yaml_file)
+        assert qty.load_yaml(f) == YAML_DATA[2][1]
+
+
 @pytest.mark.raises(exception=TypeError)
 @pytest.mark.parametrize("trace, device", [
     ([], None),